@@ -2,11 +2,17 @@ import sys
 import os
 import argparse 
 import zipfile
-import tempfile
-import random
+import mmap
 import logging
-import xml.etree.ElementTree as ET
-from datetime import datetime, date
+try:
+    from lxml import etree as ET
+    _HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _HAVE_LXML = False
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from contextlib import contextmanager
 
 
 FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
@@ -15,13 +21,42 @@ logger = logging.getLogger('apple_health')
 logger.setLevel(logging.DEBUG)
 
 
-def process_data_files(exportfile, cdafile):
-    logger.info(f"Processing Export File {exportfile}")
-    print()
-    print("start_date,end_date,observation_time,hr_bpm")
-    tree = ET.parse(exportfile)
-    root = tree.getroot()  
+# Number of buffered output rows written to stdout at a time
+_FLUSH_ROWS = 1 << 16
+
+
+# Exports repeat the same timestamps many times over, so memoize the parses.
+# The cache is bounded to keep memory flat on exports with mostly-unique dates.
+@lru_cache(maxsize=1 << 17)
+def _parse_full(s):
+    # Apple always writes fixed-width 'YYYY-MM-DD HH:MM:SS +HHMM', so slice
+    # that directly and leave anything else to strptime
+    if len(s) != 25 or s[19] != ' ' or s[20] not in '+-':
+        return datetime.strptime(s, '%Y-%m-%d %H:%M:%S %z')
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                    int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                    tzinfo=_parse_tz(s[20:]))
+
+
+@lru_cache(maxsize=None)
+def _parse_tz(s):
+    offset = timedelta(hours=int(s[1:3]), minutes=int(s[3:5]))
+    return timezone(-offset if s[0] == '-' else offset)
+
+
+@lru_cache(maxsize=1 << 17)
+def _parse_time(s):
+    return datetime.strptime(s, '%H:%M:%S.%f %p').time()
+
+
+_DAY_US = 24 * 60 * 60 * 1_000_000
+
+
+def _to_us(t):
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000 + t.microsecond
 
+
+def _emit_hr(a, node, emit):
     # Extract 1
     # Extract first order HR observations
     # https://developer.apple.com/documentation/healthkit/hkquantitytypeidentifier/2881127-heartratevariabilitysdnn
@@ -37,7 +72,15 @@ def process_data_files(exportfile, cdafile):
          endDate="2017-11-15 00:13:33 -0400" 
          value="76">
      '''    
+    bpm = a.get('value')
+    if bpm is not None:
+        st = a['startDate']
+        ed = a['endDate']
+        #emit(f"{st},{ed},,{bpm}\n")
+        emit(f"{st},{bpm}\n")
+
 
+def _emit_hrv(a, node, emit):
     # Extract 2
     # Extract HR observations from HR Variability SD
     # https://developer.apple.com/documentation/healthkit/hkquantitytypeidentifier/2881127-heartratevariabilitysdnn
@@ -59,49 +102,121 @@ def process_data_files(exportfile, cdafile):
        <InstantaneousBeatsPerMinute bpm="93" time="6:14:50.88 PM"/>
     '''
 
-    for child in root.iter():
-        #print(child.tag)
-        if child.tag == 'Record':
-            #print(child.tag)
-            if 'type' in child.attrib:
-
-                if child.attrib['type']=='HKQuantityTypeIdentifierHeartRate':
-                    if 'value' in child.attrib:
-                        st = child.attrib['startDate']
-                        ed = child.attrib['endDate']
-                        bpm = child.attrib['value']
-                        #print(f"{st},{ed},,{bpm}")
-                        print(f"{st},{bpm}")
-
-                elif child.attrib['type']=='HKQuantityTypeIdentifierHeartRateVariabilitySDNN':
-
-                    seq_st = child.attrib['startDate']
-                    seq_ed = child.attrib['endDate']
-
-                    seq_st_dt = datetime.strptime(seq_st, '%Y-%m-%d %H:%M:%S %z')
-
-                    grandchildren = child.iter()
-                    obs_first = None
-                    for gc in grandchildren:
-                        if gc.tag == 'InstantaneousBeatsPerMinute':
-                            if not obs_first:
-                                obs_first = gc.attrib['time']
-                                st_dt = datetime.strptime(obs_first, '%H:%M:%S.%f %p')
-                            
-                            if 'bpm' in gc.attrib:
-                                bpm = gc.attrib['bpm']
-
-                                # Derive elapsed time offset within observation series
-                                tm = gc.attrib['time']
-                                ed_dt = datetime.strptime(tm, '%H:%M:%S.%f %p')
-                                time_offset = datetime.combine(date.min, ed_dt.time()) - datetime.combine(date.min, st_dt.time())
-
-                                # Apply elapsed time offset to sequence start time
-                                seq_st_dt_plusdelta = seq_st_dt+time_offset
-
-                                print(f"{seq_st_dt_plusdelta},{bpm}")
-                                #print(f"{st},{ed},{time_offset},{bpm}")
-                                #print(f"{seq_st},{seq_ed},{tm},{time_offset},{seq_st_dt_plusdelta},{bpm}")
+    st = a['startDate']
+
+    # Beat times within one record repeat often; remember their offsets here
+    # so the shared parse cache is only consulted once per distinct time
+    seen = {}
+    obs_first = None
+    for gc in node.iter('InstantaneousBeatsPerMinute'):
+        ga = gc.attrib
+        if not obs_first:
+            # Only pay for the sequence start parse once there are beats to place
+            seq_st_dt = _parse_full(st)
+            obs_first = ga['time']
+            st_us = seen[obs_first] = _to_us(_parse_time(obs_first))
+
+            # Rows share the sequence's date and UTC offset, so format those
+            # once and only render the time of day for each beat
+            iso = str(seq_st_dt)
+            day, tz = iso[:11], iso[19:]
+            base_us = _to_us(seq_st_dt) - st_us
+
+        bpm = ga.get('bpm')
+        if bpm is not None:
+            # Derive elapsed time offset within observation series
+            tm = ga['time']
+            ed_us = seen.get(tm)
+            if ed_us is None:
+                ed_us = seen[tm] = _to_us(_parse_time(tm))
+
+            # Apply elapsed time offset to sequence start time
+            tod_us = base_us + ed_us
+            if 0 <= tod_us < _DAY_US:
+                sec, us = divmod(tod_us, 1_000_000)
+                mins, sec = divmod(sec, 60)
+                hr, mins = divmod(mins, 60)
+                if us:
+                    emit(f"{day}{hr:02d}:{mins:02d}:{sec:02d}.{us:06d}{tz},{bpm}\n")
+                else:
+                    emit(f"{day}{hr:02d}:{mins:02d}:{sec:02d}{tz},{bpm}\n")
+            else:
+                # Offset carries past a day boundary, let datetime roll the date
+                time_offset = timedelta(microseconds=ed_us - st_us)
+                seq_st_dt_plusdelta = seq_st_dt+time_offset
+                emit(f"{seq_st_dt_plusdelta},{bpm}\n")
+            #emit(f"{st},{ed},{time_offset},{bpm}\n")
+
+
+# Record types we extract, mapped to the handler that emits their rows
+_HANDLERS = {
+    'HKQuantityTypeIdentifierHeartRate': _emit_hr,
+    'HKQuantityTypeIdentifierHeartRateVariabilitySDNN': _emit_hrv,
+}
+
+
+def process_record(node, emit):
+    # Most records are types we don't extract; reject those from the type
+    # alone, before building the attrib mapping (a proxy object under lxml)
+    h = _HANDLERS.get(node.get('type'))
+    if h is None:
+        return
+    h(node.attrib, node, emit)
+
+
+def _iter_records(exportfile):
+    # Stream Record elements out of the export rather than loading the whole
+    # document, releasing each one (and whatever preceded it) once handled.
+    if _HAVE_LXML:
+        # lxml only hands back the tags we ask for, so the many elements we
+        # never look at don't get Python wrappers built for them
+        context = ET.iterparse(exportfile, events=('end',), tag='Record', huge_tree=True)
+        for _, elem in context:
+            yield elem
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    else:
+        # The first start event hands us the root so it can be emptied
+        context = ET.iterparse(exportfile, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag == 'Record':
+                yield elem
+                elem.clear()
+                root.clear()
+
+
+@contextmanager
+def _open_export(exportfile):
+    # Map export files on disk so the kernel can read ahead sequentially
+    # without an extra copy; already-open streams (zip members) pass through
+    if not isinstance(exportfile, str):
+        yield exportfile
+        return
+    with open(exportfile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        advice = getattr(mmap, 'MADV_SEQUENTIAL', None)
+        if advice is not None:
+            mm.madvise(advice)
+        yield mm
+
+
+def process_data_files(exportfile, cdafile):
+    logger.info(f"Processing Export File {getattr(exportfile, 'name', exportfile)}")
+    print()
+    print("start_date,end_date,observation_time,hr_bpm")
+
+    # Rows are collected and written out in large chunks rather than per line
+    out = sys.stdout
+    buf = []
+    emit = buf.append
+    with _open_export(exportfile) as source:
+        for child in _iter_records(source):
+            process_record(child, emit)
+            if len(buf) >= _FLUSH_ROWS:
+                out.write(''.join(buf))
+                buf.clear()
+    out.write(''.join(buf))
     return True
 
 def prep_and_process_files(infile, indir):
@@ -124,36 +239,29 @@ def prep_and_process_files(infile, indir):
             raise Exception(f"Received input directory, but expected input file {input_file} not found")        
 
 
-        with tempfile.TemporaryDirectory() as tempdir_tarball_contents:
-
-            randomizer = str(random.randint(10000, 99999))
-            extract_dir = os.path.join(tempdir_tarball_contents, randomizer)
-            os.mkdir(extract_dir)
-
-            logger.info(f"Working in folder {extract_dir}")
-            zip_ref = zipfile.ZipFile(input_file, 'r')
-            zip_ref.extractall(extract_dir)
-            zip_ref.close()
-
-            import glob
-            extracted_files = glob.glob(os.path.join(extract_dir, 'apple_health_export', '*'))
-            logger.info("Files extracted during preparation:")
-            for ef in extracted_files:
-                logger.info(f"\tFile: {ef}")
-
+        # Read the export straight out of the zipball instead of extracting
+        # the (often multi-GB) export.xml to disk first
+        logger.info(f"Reading archive {input_file}")
+        with zipfile.ZipFile(input_file, 'r') as zip_ref:
+            archived_files = set(zip_ref.namelist())
+            logger.info("Files found during preparation:")
+            for af in sorted(archived_files):
+                if os.path.dirname(af.rstrip('/')) == "apple_health_export":
+                    logger.info(f"\tFile: {af}")
 
-            keyfile1 = os.path.join(extract_dir, "apple_health_export", "export_cda.xml")
-            keyfile2 = os.path.join(extract_dir, "apple_health_export", "export.xml")
+            keyfile1 = "apple_health_export/export_cda.xml"
+            keyfile2 = "apple_health_export/export.xml"
 
-            if not (os.path.exists(keyfile1)):
+            if keyfile1 not in archived_files:
                 logger.error(f"Bad input file received, missing key file export_cda.xml")            
                 raise Exception(f"Bad input file received, missing key file export_cda.xml")
 
-            if not (os.path.exists(keyfile2)):
+            if keyfile2 not in archived_files:
                 logger.error(f"Bad input file received, missing key file export.xml")
                 raise Exception(f"Bad input file received, missing key file export.xml")
 
-            return process_data_files(keyfile2, keyfile1)
+            with zip_ref.open(keyfile2) as exportfile:
+                return process_data_files(exportfile, None)
 
 
     if indir: